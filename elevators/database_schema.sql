@@ -2,7 +2,7 @@
 CREATE TABLE states(
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     current_floor INTEGER NOT NULL,
-    state_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    state_time TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
     vacant BOOLEAN NOT NULL,
     mooving BOOLEAN NOT NULL
 );
@@ -11,5 +11,15 @@ CREATE TABLE states(
 CREATE TABLE demands (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     demand_floor INTEGER NOT NULL,
-    demand_time  TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-);
\ No newline at end of file
+    demand_time  TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Events table: resting states and demands materialized for the training dataset
+CREATE TABLE events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    is_resting BOOLEAN NOT NULL,
+    floor INTEGER NOT NULL,
+    time TIMESTAMP NOT NULL
+);
+
+CREATE INDEX ix_events_time ON events (time);
\ No newline at end of file
@@ -1,17 +1,87 @@
-from fastapi import FastAPI, HTTPException, Depends
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Depends, Request
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, ConfigDict
+from asyncio import current_task
 from datetime import datetime
-from sqlalchemy import create_engine, Column, Boolean, Integer, DateTime, literal
-from sqlalchemy.orm import declarative_base, sessionmaker, Session
+from typing import Optional
+import asyncio
+import gzip
+import hashlib
+import os
+import tempfile
+import time
+import anyio.to_thread
+import orjson
+from sqlalchemy import event, func, Column, Boolean, Integer, DateTime, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_scoped_session, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 
-DATABASE_URL = "sqlite:///./elevators.db"
+DATABASE_PATH = "./elevators.db"
+DATABASE_URL = f"sqlite+aiosqlite:///{DATABASE_PATH}"
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+#Keep a pool of connections so concurrent requests can read in parallel under WAL
+engine = create_async_engine(
+    DATABASE_URL,
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=5,
+    max_overflow=10,
+    pool_recycle=3600,
+    pool_pre_ping=True
+)
+
+#SQLite settings applied to every new connection
+SQLITE_PRAGMAS = (
+    "journal_mode=WAL",      # readers no longer block on writers
+    "synchronous=NORMAL",    # fsync at checkpoints instead of every commit
+    "temp_store=MEMORY",
+    "cache_size=-64000",     # 64MB page cache
+    "mmap_size=268435456",   # 256MB memory-mapped I/O
+    "foreign_keys=ON",
+)
+
+@event.listens_for(engine.sync_engine, "connect")
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    """
+    Apply SQLITE_PRAGMAS to a freshly opened SQLite connection.
+    """
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(f"PRAGMA {pragma}")
+    cursor.close()
+
+#One session per asyncio task (i.e. per request), handed out from a registry over the pool
+SessionFactory = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+SessionLocal = async_scoped_session(SessionFactory, scopefunc=current_task)
+
+#Relationships are never lazy loaded: models declare them with relationship(..., lazy="raise"),
+#so ORM queries must request them with selectinload()/joinedload() (or the relationship must
+#declare an eager lazy= strategy) instead of issuing one query per row.
+#test_relationships_are_not_lazy_loaded fails on any relationship left with the default lazy="select".
 Base = declarative_base()
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
+
+#Compress responses over 1KB for clients sending Accept-Encoding: gzip
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
+#Rows sent to the database per INSERT statement by the bulk endpoints
+BULK_CHUNK_SIZE = 1000
+
+#Rows fetched from the database per batch by the streaming endpoints
+STREAM_BATCH_SIZE = 1000
+
+#Gzip compressed snapshots of the /dataset response, kept in a private directory next to the database.
+#Each file is named after the highest event id it holds, so any worker can tell from the database whether it is current.
+DATASET_SNAPSHOT_DIR = os.path.join(os.path.dirname(DATABASE_PATH), "dataset_snapshots")
+DATASET_SNAPSHOT_MAX_AGE = 30  # seconds a snapshot behind the database may still be served
+DATASET_SNAPSHOT_CHUNK_SIZE = 64 * 1024  # bytes read from the snapshot file per streamed chunk
+#This worker's latest snapshot: the event id it covers, its file, its ETag and when it was built
+dataset_snapshot = {"max_id": None, "path": None, "etag": None, "built": None}
+#The rebuild in flight, shared by every request waiting for it, and whether a write asked for another one
+dataset_rebuild = {"task": None, "pending": False}
 
 #Models to be stored in the database
 
@@ -28,7 +98,7 @@ class State(Base):
     __tablename__ = "states"
     id = Column(Integer, autoincrement=True, primary_key=True, index=True)
     current_floor = Column(Integer, nullable=False)
-    state_time = Column(DateTime, default=datetime.utcnow)
+    state_time = Column(DateTime, server_default=func.current_timestamp(), nullable=False)
     vacant = Column(Boolean,  nullable=False)
     mooving = Column(Boolean,  nullable=False)
     
@@ -43,140 +113,532 @@ class Demand(Base):
     __tablename__ = "demands"
     id = Column(Integer, autoincrement=True, primary_key=True, index=True)
     demand_floor = Column(Integer, nullable=False)
-    demand_time = Column(DateTime, default=datetime.utcnow)
+    demand_time = Column(DateTime, server_default=func.current_timestamp(), nullable=False)
+
+class Event(Base):
+    """
+    The Event class materializes the training dataset: one row per resting state or demand,
+    written in the same transaction as the record it comes from.
+    Attributes:
+        id (int): The unique identifier for the event record.
+        is_resting (bool): True if the event is a resting state, False if it is a demand.
+        floor (int): The elevator floor associated with the event.
+        time (datetime): The timestamp of the event.
+    """
+    __tablename__ = "events"
+    id = Column(Integer, autoincrement=True, primary_key=True)
+    is_resting = Column(Boolean, nullable=False)
+    floor = Column(Integer, nullable=False)
+    time = Column(DateTime, nullable=False, index=True)
 
     
 
+#Write path statements, built once so SQLAlchemy reuses their compiled SQL
+INSERT_STATE = State.__table__.insert().returning(*State.__table__.c)
+INSERT_DEMAND = Demand.__table__.insert().returning(*Demand.__table__.c)
+INSERT_EVENT = Event.__table__.insert()
+
+
 #Pydantic Schemas
 
+#Times left out by the client are assigned by the database when the record is stored
 class StateBase(BaseModel):
     current_floor: int
-    state_time: datetime
+    state_time: Optional[datetime] = None
     vacant: bool
     mooving: bool
 
 class DemandBase(BaseModel):
     demand_floor : int
-    demand_time : datetime
+    demand_time : Optional[datetime] = None
+
+#Response schemas, read straight from the ORM instances or rows
+class StateOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+    id: int
+    current_floor: int
+    state_time: datetime
+    vacant: bool
+    mooving: bool
+
+class DemandOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+    id: int
+    demand_floor: int
+    demand_time: datetime
+
+class DatasetEvent(BaseModel):
+    event_type_is_resting: bool
+    floor: int
+    time: datetime
+
+class BulkInserted(BaseModel):
+    inserted: int
 
 
 #Dependency or Data Base Session
-def get_db():
+def get_session_factory() -> async_sessionmaker:
+    return SessionFactory
+
+async def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close()
+        await SessionLocal.remove()
+
+
+#Conditional request helpers
+def make_etag(value, weak: bool = False) -> str:
+    """
+    Build a quoted ETag from a short hash of the given value.
+    A weak ETag (W/"...") is shared by every content coding of the same data, e.g. gzip and identity.
+    """
+    digest = hashlib.blake2b(value if isinstance(value, bytes) else str(value).encode(), digest_size=8)
+    return f'{"W/" if weak else ""}"{digest.hexdigest()}"'
+
+async def table_etag(db: AsyncSession, model) -> str:
+    """
+    Build the ETag of an append-only table from its highest id, read from the primary key index.
+    The ETag is weak: the GZip middleware may compress the response, so the bytes depend on Accept-Encoding.
+    Args:
+        db (AsyncSession): The database session.
+        model: The mapped class of the table.
+    Returns:
+        str: The quoted weak ETag.
+    """
+    max_id = await db.scalar(select(func.max(model.id)))
+    return make_etag(f"{model.__tablename__}:{max_id}", weak=True)
+
+def not_modified(request: Request, etag: str) -> bool:
+    """
+    Check whether the client already holds the representation identified by etag.
+    If-None-Match uses the weak comparison: the W/ prefix is ignored on both sides.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+    opaque_tag = etag.removeprefix("W/")
+    return if_none_match.strip() == "*" or opaque_tag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+
+
+#Dataset snapshot helpers
+async def latest_event_id(db: AsyncSession) -> int:
+    """
+    Read the highest event id from the primary key index, 0 while no event is logged.
+    """
+    return await db.scalar(select(func.max(Event.id))) or 0
+
+def dataset_snapshot_usable(max_id: int) -> bool:
+    """
+    Check whether this worker's snapshot may be served while the highest event id is max_id:
+    it holds every event, or it is behind but younger than DATASET_SNAPSHOT_MAX_AGE.
+    """
+    if dataset_snapshot["max_id"] is None:
+        return False
+    return (
+        dataset_snapshot["max_id"] >= max_id
+        or time.monotonic() - dataset_snapshot["built"] < DATASET_SNAPSHOT_MAX_AGE
+    )
+
+def open_dataset_snapshot() -> dict:
+    """
+    Start writing a snapshot to a temporary file in DATASET_SNAPSHOT_DIR, as a gzip compressed JSON array.
+    Runs in a worker thread, like the other snapshot writers.
+    Returns:
+        dict: The writer, passed to write_dataset_rows() and close_dataset_snapshot().
+    """
+    os.makedirs(DATASET_SNAPSHOT_DIR, mode=0o700, exist_ok=True)
+    file = tempfile.NamedTemporaryFile(dir=DATASET_SNAPSHOT_DIR, suffix=".tmp", delete=False)
+    writer = {
+        "file": file,
+        "gzip": gzip.GzipFile(fileobj=file, mode="wb", compresslevel=5),
+        "hash": hashlib.blake2b(digest_size=8),
+        "max_id": 0,
+        "first": True
+    }
+    write_dataset_bytes(writer, b"[")
+    return writer
+
+def write_dataset_bytes(writer: dict, data: bytes):
+    """
+    Append encoded bytes to the snapshot being written, and to the hash its ETag is built from.
+    """
+    writer["gzip"].write(data)
+    writer["hash"].update(data)
+
+def write_dataset_rows(writer: dict, keys: tuple, rows: list):
+    """
+    Encode a batch of dataset rows with orjson and append them to the snapshot being written.
+    Args:
+        writer (dict): The writer returned by open_dataset_snapshot().
+        keys (tuple): The dataset keys, in the column order of the rows.
+        rows (list): The dataset rows, with the event id as an extra last column.
+    """
+    # Rows are already labelled with the dataset keys: pairing the plain row tuples with the
+    # labels is cheaper than building RowMapping objects and converting each one for orjson.
+    # zip() stops at the last key, leaving the trailing event id out of the dataset.
+    body = orjson.dumps([dict(zip(keys, row)) for row in rows])[1:-1]
+    if not body:
+        return
+    write_dataset_bytes(writer, body if writer["first"] else b"," + body)
+    writer["first"] = False
+    writer["max_id"] = max(writer["max_id"], max(row[-1] for row in rows))
+
+def close_dataset_snapshot(writer: dict) -> dict:
+    """
+    Finish the snapshot being written and move it to the file named after the highest event id it holds.
+    Args:
+        writer (dict): The writer returned by open_dataset_snapshot().
+    Returns:
+        dict: The new snapshot.
+    """
+    write_dataset_bytes(writer, b"]")
+    writer["gzip"].close()
+    writer["file"].close()
+    path = os.path.join(DATASET_SNAPSHOT_DIR, f"dataset-{writer['max_id']}.json.gz")
+    # Readers never see a partial snapshot: the complete file replaces the old one in a single step.
+    os.replace(writer["file"].name, path)
+
+    # Keep the previous snapshot too, other workers are likely still serving it.
+    # Workers open a snapshot before sending it, and rebuild if it was removed in the meantime.
+    snapshots = sorted(
+        (int(name[len("dataset-"):-len(".json.gz")]), name)
+        for name in os.listdir(DATASET_SNAPSHOT_DIR)
+        if name.startswith("dataset-") and name.endswith(".json.gz")
+    )
+    for _, name in snapshots[:-2]:
+        os.remove(os.path.join(DATASET_SNAPSHOT_DIR, name))
+    return {"max_id": writer["max_id"], "path": path, "etag": make_etag(writer["hash"].digest())}
+
+def discard_dataset_snapshot(writer: dict):
+    """
+    Remove the temporary file of a snapshot whose build failed.
+    """
+    writer["gzip"].close()
+    writer["file"].close()
+    os.remove(writer["file"].name)
+
+async def build_dataset_snapshot(session_factory: async_sessionmaker):
+    """
+    Stream the dataset events in batches of STREAM_BATCH_SIZE into a new snapshot file and make it this worker's snapshot.
+    Only one batch of rows is held in memory; encoding, compression and file I/O run in worker threads.
+    Args:
+        session_factory (async_sessionmaker): Opens the session used for the query.
+    """
+    # Events are materialized on write, the dataset is a single scan of the time index.
+    # SQLite reads a single statement from one consistent state of the database, so the highest
+    # id among the fetched rows names exactly the events the snapshot holds.
+    query = select(
+        Event.is_resting.label("event_type_is_resting"),
+        Event.floor,
+        Event.time,
+        Event.id
+    ).order_by(Event.time)
+
+    writer = await anyio.to_thread.run_sync(open_dataset_snapshot)
+    try:
+        async with session_factory() as db:
+            results = await db.stream(query.execution_options(yield_per=STREAM_BATCH_SIZE))
+            keys = tuple(results.keys())[:-1]
+            async for rows in results.partitions():
+                await anyio.to_thread.run_sync(write_dataset_rows, writer, keys, rows)
+        snapshot = await anyio.to_thread.run_sync(close_dataset_snapshot, writer)
+    except BaseException:
+        await anyio.to_thread.run_sync(discard_dataset_snapshot, writer)
+        raise
+
+    # A build that started later may have finished first, never replace a newer snapshot.
+    if dataset_snapshot["max_id"] is None or dataset_snapshot["max_id"] <= snapshot["max_id"]:
+        dataset_snapshot.update(snapshot, built=time.monotonic())
+
+async def run_dataset_rebuilds(session_factory: async_sessionmaker):
+    """
+    Rebuild the snapshot, again as long as writes asked for a rebuild while the previous one ran.
+    """
+    while True:
+        dataset_rebuild["pending"] = False
+        await build_dataset_snapshot(session_factory)
+        if not dataset_rebuild["pending"]:
+            return
+
+async def rebuild_dataset_snapshot(session_factory: async_sessionmaker):
+    """
+    Wait for the rebuild in flight, starting one if there is none: at most one rebuild runs at a time.
+    Args:
+        session_factory (async_sessionmaker): Opens the session of the rebuild.
+    """
+    task = dataset_rebuild["task"]
+    if task is None or task.done():
+        task = asyncio.ensure_future(run_dataset_rebuilds(session_factory))
+        dataset_rebuild["task"] = task
+    # A client disconnecting must not cancel a rebuild other requests are waiting for.
+    await asyncio.shield(task)
+
+async def refresh_dataset_snapshot(session_factory: async_sessionmaker):
+    """
+    Background task run after a write, or after /dataset served a snapshot behind the database.
+    Writes arriving while a rebuild runs are coalesced into a single follow-up rebuild.
+    The request's session is already closed when this runs, the rebuild opens its own from session_factory.
+    Args:
+        session_factory (async_sessionmaker): Opens the session of the rebuild.
+    """
+    task = dataset_rebuild["task"]
+    if task is not None and not task.done():
+        dataset_rebuild["pending"] = True
+        return
+    await rebuild_dataset_snapshot(session_factory)
+
+def read_dataset_snapshot(snapshot_file, decompress: bool):
+    """
+    Yield an open snapshot file in chunks of DATASET_SNAPSHOT_CHUNK_SIZE, then close it.
+    StreamingResponse iterates this generator in a worker thread.
+    Args:
+        snapshot_file: The snapshot file, opened in binary mode.
+        decompress (bool): Whether to decompress the snapshot, for clients without gzip.
+    Yields:
+        bytes: Chunks of the snapshot.
+    """
+    with snapshot_file:
+        reader = gzip.GzipFile(fileobj=snapshot_file, mode="rb") if decompress else snapshot_file
+        while chunk := reader.read(DATASET_SNAPSHOT_CHUNK_SIZE):
+            yield chunk
+
+
+#Streaming helper
+async def stream_json(db: AsyncSession, statement):
+    """
+    Stream the rows of a query as a JSON array, fetching them in batches of STREAM_BATCH_SIZE.
+    The query runs inside the generator, which closes the session once the array is sent.
+    Args:
+        db (AsyncSession): The database session.
+        statement: The Core select whose rows are streamed.
+    Yields:
+        bytes: Chunks of the JSON array.
+    """
+    try:
+        result = await db.stream(statement.execution_options(yield_per=STREAM_BATCH_SIZE))
+        yield b"["
+        first = True
+        async for row in result:
+            if not first:
+                yield b","
+            first = False
+            yield orjson.dumps(row._asdict())
+        yield b"]"
+    finally:
+        await db.close()
+
+
+#Bulk insertion helper
+async def bulk_insert(db: AsyncSession, statement, rows: list[dict]) -> list:
+    """
+    Execute an INSERT for many rows, in chunks of BULK_CHUNK_SIZE, without committing.
+    Args:
+        db (AsyncSession): The database session.
+        statement: The INSERT statement, optionally with a RETURNING clause.
+        rows (list[dict]): The rows to insert.
+    Returns:
+        list: The rows produced by the RETURNING clause, if any.
+    """
+    returned = []
+    for start in range(0, len(rows), BULK_CHUNK_SIZE):
+        result = await db.execute(statement, rows[start:start + BULK_CHUNK_SIZE])
+        if statement.exported_columns:
+            returned.extend(result.all())
+    return returned
 
 
 #Endpoints
-@app.get("/state", summary = 'Get all elevator states', description = 'Get all situations related to the elavator')
-def read_states(db: Session = Depends(get_db)):
+@app.get("/state", summary = 'Get all elevator states', description = 'Get all situations related to the elavator',
+         response_model=list[StateOut])
+async def read_states(request: Request, db: AsyncSession = Depends(get_db)):
     """
     Retrieve all state records.
     Args:
-        db (Session): The database session dependency.
+        request (Request): The incoming request, checked for If-None-Match.
+        db (AsyncSession): The database session dependency.
     Returns:
-        List[State]: A list of all state records.
+        StreamingResponse: A JSON list of all state records, streamed in batches,
+        or an empty 304 response if the client's copy is still current.
     """
     
-    states = db.query(State).all()
-    return states
+    etag = await table_etag(db, State)
+    if not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    query = select(State.id, State.current_floor, State.state_time, State.vacant, State.mooving)
+    return StreamingResponse(stream_json(db, query), media_type="application/json", headers={"ETag": etag})
 
 @app.post("/state", summary = 'Log a new elevator state', 
-          description = 'Crate a situation of the elevator, whether it is moving, vacant, current floor and time', status_code=201)
-def create_state(state: StateBase, db: Session = Depends(get_db)):
+          description = 'Crate a situation of the elevator, whether it is moving, vacant, current floor and time', status_code=201,
+          response_model=StateOut)
+async def create_state(state: StateBase, background_tasks: BackgroundTasks, db: AsyncSession = Depends(get_db),
+                       session_factory: async_sessionmaker = Depends(get_session_factory)):
     """
-    Log a new state record.
+    Log a new state record, and a dataset event if the elevator is resting.
     Args:
         state (StateBase): The state data to be logged.
-        db (Session): The database session dependency.
+        background_tasks (BackgroundTasks): Runs the dataset snapshot rebuild after the response.
+        db (AsyncSession): The database session dependency.
+        session_factory (async_sessionmaker): Opens the session of the snapshot rebuild.
     Returns:
-        State: The newly created state record.
+        Row: The newly created state record, as returned by the INSERT.
     """
-    new_state = State(
-        current_floor=state.current_floor,
-        vacant=state.vacant,
-        mooving=state.mooving,
-        state_time=state.state_time
-    )
-    db.add(new_state)
-    db.commit()
-    db.refresh(new_state)
+    # Core INSERT ... RETURNING: no ORM unit of work, and the id and stored time come back with the insert.
+    new_state = (await db.execute(INSERT_STATE, state.model_dump(exclude_none=True))).one()
+    if new_state.vacant and not new_state.mooving:
+        await db.execute(INSERT_EVENT, {"is_resting": True, "floor": new_state.current_floor, "time": new_state.state_time})
+    await db.commit()
+    background_tasks.add_task(refresh_dataset_snapshot, session_factory)
     return new_state
 
+@app.post("/state/bulk", summary = 'Log many elevator states', 
+          description = 'Create several situations of the elevator in a single transaction', status_code=201,
+          response_model=BulkInserted)
+async def create_states_bulk(states: list[StateBase], background_tasks: BackgroundTasks, db: AsyncSession = Depends(get_db),
+                       session_factory: async_sessionmaker = Depends(get_session_factory)):
+    """
+    Log many state records at once.
+    Batches of up to ~10k records per request are recommended; they are inserted in chunks of BULK_CHUNK_SIZE.
+    Args:
+        states (list[StateBase]): The state data to be logged.
+        background_tasks (BackgroundTasks): Runs the dataset snapshot rebuild after the response.
+        db (AsyncSession): The database session dependency.
+        session_factory (async_sessionmaker): Opens the session of the snapshot rebuild.
+    Returns:
+        BulkInserted: The number of inserted state records.
+    """
+    rows = [state.model_dump(exclude_none=True) for state in states]
+    inserted = await bulk_insert(
+        db,
+        insert(State).returning(State.current_floor, State.state_time, State.vacant, State.mooving),
+        rows
+    )
+    events = [
+        {"is_resting": True, "floor": row.current_floor, "time": row.state_time}
+        for row in inserted if row.vacant and not row.mooving
+    ]
+    await bulk_insert(db, INSERT_EVENT, events)
+    await db.commit()
+    background_tasks.add_task(refresh_dataset_snapshot, session_factory)
+    return {"inserted": len(rows)}
+
 
-@app.get("/demand", summary = 'Get all elevator demands', description = 'Get all demands related to the elavator')
-def read_demands(db: Session = Depends(get_db)):
+@app.get("/demand", summary = 'Get all elevator demands', description = 'Get all demands related to the elavator',
+         response_model=list[DemandOut])
+async def read_demands(request: Request, db: AsyncSession = Depends(get_db)):
     """
     Retrieve all demand records.
     Args:
-        db (Session): The database session dependency. 
+        request (Request): The incoming request, checked for If-None-Match.
+        db (AsyncSession): The database session dependency. 
     Returns:
-        List[Demand]: A list of all demand records.
+        StreamingResponse: A JSON list of all demand records, streamed in batches,
+        or an empty 304 response if the client's copy is still current.
     """
-    demands = db.query(Demand).all()
-    return demands
+    etag = await table_etag(db, Demand)
+    if not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    query = select(Demand.id, Demand.demand_floor, Demand.demand_time)
+    return StreamingResponse(stream_json(db, query), media_type="application/json", headers={"ETag": etag})
 
 @app.post("/demand", summary = 'Log a new elevator demand', 
-          description = 'Crate a new demand for the elevator', status_code=201)
+          description = 'Crate a new demand for the elevator', status_code=201,
+          response_model=DemandOut)
 
-def create_demand(demand: DemandBase, db: Session = Depends(get_db)):
+async def create_demand(demand: DemandBase, background_tasks: BackgroundTasks, db: AsyncSession = Depends(get_db),
+                       session_factory: async_sessionmaker = Depends(get_session_factory)):
     """
     Log a new demand record and automatically generate a new state.
     Args:
         demand (DemandBase): The demand data to be logged.
-        db (Session): The database session dependency.
+        background_tasks (BackgroundTasks): Runs the dataset snapshot rebuild after the response.
+        db (AsyncSession): The database session dependency.
+        session_factory (async_sessionmaker): Opens the session of the snapshot rebuild.
         
     Returns:
-        Demand: The newly created demand record.
+        Row: The newly created demand record, as returned by the INSERT.
     """
     
     # Log the demand.
-    new_demand = Demand(
-        demand_floor= demand.demand_floor,
-        demand_time= demand.demand_time 
-    )
-    db.add(new_demand)
-    db.commit()
-    db.refresh(new_demand)
+    new_demand = (await db.execute(INSERT_DEMAND, demand.model_dump(exclude_none=True))).one()
+    await db.execute(INSERT_EVENT, {"is_resting": False, "floor": new_demand.demand_floor, "time": new_demand.demand_time})
+    await db.commit()
+    background_tasks.add_task(refresh_dataset_snapshot, session_factory)
     
     return new_demand
 
-@app.get("/dataset", summary='Get dataset for model training', description='Returns a dataset for training the prediction model')
-def get_dataset(db: Session = Depends(get_db)):
+@app.post("/demand/bulk", summary = 'Log many elevator demands', 
+          description = 'Create several demands for the elevator in a single transaction', status_code=201,
+          response_model=BulkInserted)
+async def create_demands_bulk(demands: list[DemandBase], background_tasks: BackgroundTasks, db: AsyncSession = Depends(get_db),
+                       session_factory: async_sessionmaker = Depends(get_session_factory)):
+    """
+    Log many demand records at once.
+    Batches of up to ~10k records per request are recommended; they are inserted in chunks of BULK_CHUNK_SIZE.
+    Args:
+        demands (list[DemandBase]): The demand data to be logged.
+        background_tasks (BackgroundTasks): Runs the dataset snapshot rebuild after the response.
+        db (AsyncSession): The database session dependency.
+        session_factory (async_sessionmaker): Opens the session of the snapshot rebuild.
+    Returns:
+        BulkInserted: The number of inserted demand records.
+    """
+    rows = [demand.model_dump(exclude_none=True) for demand in demands]
+    inserted = await bulk_insert(db, insert(Demand).returning(Demand.demand_floor, Demand.demand_time), rows)
+    events = [
+        {"is_resting": False, "floor": row.demand_floor, "time": row.demand_time}
+        for row in inserted
+    ]
+    await bulk_insert(db, INSERT_EVENT, events)
+    await db.commit()
+    background_tasks.add_task(refresh_dataset_snapshot, session_factory)
+    return {"inserted": len(rows)}
+
+@app.get("/dataset", summary='Get dataset for model training', description='Returns a dataset for training the prediction model',
+         response_model=list[DatasetEvent])
+async def get_dataset(request: Request, background_tasks: BackgroundTasks, db: AsyncSession = Depends(get_db),
+                      session_factory: async_sessionmaker = Depends(get_session_factory)):
     """
     Retrieve a dataset suitable for training a prediction model.
+    The dataset is streamed from a gzip compressed snapshot file, rebuilt in the background after writes.
+    A snapshot behind the database is still served while it is younger than DATASET_SNAPSHOT_MAX_AGE,
+    the request is only held for a rebuild when there is no snapshot yet or it is older.
+    The ETag is a hash of the encoded dataset, a client sending it back in If-None-Match gets an empty 304 response.
     Args:
-        db (Session): The database session dependency.     
+        request (Request): The incoming request, checked for If-None-Match and Accept-Encoding.
+        background_tasks (BackgroundTasks): Runs the dataset snapshot rebuild after the response.
+        db (AsyncSession): The database session dependency.
+        session_factory (async_sessionmaker): Opens the session of the snapshot rebuild.
     Returns:
         List[dict]: A list of records where each record contains:
             - event_type_is_resting (bool): True if the event is a resting state, False if it is a demand.
             - floor (int): The elevator floor associated with the event.
             - time (datetime): The timestamp of the event.
     """
-    # Query resting states as events
-    resting_query = db.query(
-        literal(True).label("event_type_is_resting"),
-        State.current_floor.label("floor"),
-        State.state_time.label("time")
-    ).filter(
-        State.vacant == True,
-        State.mooving == False
-    )
-    
-    # Query demand events
-    demand_query = db.query(
-        literal(False).label("event_type_is_resting"),
-        Demand.demand_floor.label("floor"),
-        Demand.demand_time.label("time")
-    )
-    
-    # Combine the queries using union_all and order by the event time.
-    union_query = resting_query.union_all(demand_query).order_by("time")
-    
-    results = union_query.all()
-    
-    # Convert SQLAlchemy row objects to dictionaries.
-    dataset = [{"event_type_is_resting": row.event_type_is_resting, "floor": row.floor, "time": row.time} for row in results]
-    return dataset
\ No newline at end of file
+    max_id = await latest_event_id(db)
+    while not dataset_snapshot_usable(max_id):
+        await rebuild_dataset_snapshot(session_factory)
+    if dataset_snapshot["max_id"] < max_id:
+        background_tasks.add_task(refresh_dataset_snapshot, session_factory)
+    snapshot = dict(dataset_snapshot)
+
+    # The snapshot is sent as is to clients accepting gzip, the others get it decompressed while streaming.
+    # The two encodings are different representations: each has its own ETag, and caches must key on Accept-Encoding.
+    gzipped = "gzip" in request.headers.get("accept-encoding", "")
+    etag = f'{snapshot["etag"][:-1]}-gzip"' if gzipped else snapshot["etag"]
+    headers = {"ETag": etag, "Cache-Control": f"max-age={DATASET_SNAPSHOT_MAX_AGE}", "Vary": "Accept-Encoding"}
+    if not_modified(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    try:
+        snapshot_file = open(snapshot["path"], "rb")
+    except FileNotFoundError:
+        # Another worker removed this snapshot after building two newer ones: this worker is behind too.
+        dataset_snapshot["max_id"] = None
+        return await get_dataset(request, background_tasks, db, session_factory)
+    if gzipped:
+        headers.update({"Content-Encoding": "gzip", "Content-Length": str(os.fstat(snapshot_file.fileno()).st_size)})
+    return StreamingResponse(read_dataset_snapshot(snapshot_file, decompress=not gzipped),
+                             media_type="application/json", headers=headers)
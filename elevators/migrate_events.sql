@@ -0,0 +1,21 @@
+-- Migration for databases created before the events table existed:
+-- creates the events table and backfills it from the existing resting states and demands.
+-- Safe to run more than once, the backfill only runs while the events table is empty.
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    is_resting BOOLEAN NOT NULL,
+    floor INTEGER NOT NULL,
+    time TIMESTAMP NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS ix_events_time ON events (time);
+
+INSERT INTO events (is_resting, floor, time)
+    SELECT 1, current_floor, state_time FROM states
+    WHERE vacant = 1 AND mooving = 0 AND state_time IS NOT NULL
+        AND NOT EXISTS (SELECT 1 FROM events)
+    UNION ALL
+    SELECT 0, demand_floor, demand_time FROM demands
+    WHERE demand_time IS NOT NULL
+        AND NOT EXISTS (SELECT 1 FROM events)
+    ORDER BY 3;
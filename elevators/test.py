@@ -1,38 +1,62 @@
+import asyncio
+import gzip
+import os
 import pytest
+import sqlite3
+from contextlib import contextmanager
+import main
 from datetime import datetime, timedelta
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
-from sqlalchemy.pool import StaticPool
-from sqlalchemy.orm import sessionmaker
-from main import app, Base, get_db
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, StaticPool
+from main import app, Base, engine, get_db, get_session_factory, set_sqlite_pragma, SessionLocal
 
 #Use an in-memory SQLite database with StaticPool for testing
-SQLALCHEMY_DATABASE_URL = "sqlite:///:memory:"
-engine_test = create_engine(
+SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite:///:memory:"
+engine_test = create_async_engine(
     SQLALCHEMY_DATABASE_URL,
-    connect_args={"check_same_thread": False},
     poolclass=StaticPool
 )
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine_test)
+TestingSessionLocal = async_sessionmaker(bind=engine_test, autoflush=False, expire_on_commit=False)
 
 #Create all tables in the in-memory database
-Base.metadata.create_all(bind=engine_test)
+async def create_tables():
+    async with engine_test.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+asyncio.run(create_tables())
 
 #Override the get_db dependency to use the in-memory test database
-def override_get_db():
-    
-    db = TestingSessionLocal()
-    try:
+async def override_get_db():
+    async with TestingSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
-#Override the get_db dependency in our app.
+#Override the get_db and get_session_factory dependencies in our app.
 app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_session_factory] = lambda: TestingSessionLocal
 
 #Create a TestClient instance for our app.
 client = TestClient(app)
 
+#Write the dataset snapshots to a temporary directory managed by pytest instead of next to the database.
+@pytest.fixture(scope="session", autouse=True)
+def dataset_snapshot_dir(tmp_path_factory):
+    main.DATASET_SNAPSHOT_DIR = str(tmp_path_factory.mktemp("dataset_snapshots"))
+
+#Record the SQL statements sent to the test database while the block runs.
+@contextmanager
+def recorded_statements():
+    statements = []
+    def record_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine_test.sync_engine, "before_cursor_execute", record_statement)
+    try:
+        yield statements
+    finally:
+        event.remove(engine_test.sync_engine, "before_cursor_execute", record_statement)
+
 def test_create_and_read_state():
     """
     Test creating a new elevator state and retrieving the list of states.
@@ -64,6 +88,54 @@ def test_create_and_read_state():
     # There should be at least one state (the one we just created).
     assert len(states) > 0
 
+def test_read_states_streamed_in_batches(monkeypatch):
+    """
+    Test that /state returns every record as a JSON list when rows are streamed in several batches.
+    
+    Steps:
+      1. Shrink the streaming batch size.
+      2. POST more states than fit in one batch.
+      3. GET the states and verify every record is present and complete.
+    """
+    
+    monkeypatch.setattr(main, "STREAM_BATCH_SIZE", 2)
+    states_before = len(client.get("/state").json())
+    client.post("/state/bulk", json=[
+        {"current_floor": floor, "state_time": datetime.utcnow().isoformat(), "vacant": False, "mooving": True}
+        for floor in range(5)
+    ])
+
+    response = client.get("/state")
+    assert response.status_code == 200, f"Expected status 200, got {response.status_code}"
+    assert response.headers["content-type"] == "application/json"
+    states = response.json()
+    assert len(states) == states_before + 5
+    assert set(states[-1]) == {"id", "current_floor", "state_time", "vacant", "mooving"}
+    assert states[-1]["mooving"] is True
+
+def test_large_responses_compressed():
+    """
+    Test that large responses are gzip compressed for clients that accept it, and only for them.
+    
+    Steps:
+      1. POST enough states for the list to exceed the compression threshold.
+      2. GET the states with and without Accept-Encoding: gzip.
+      3. Verify the Content-Encoding of both responses.
+    """
+    
+    client.post("/state/bulk", json=[
+        {"current_floor": floor, "state_time": datetime.utcnow().isoformat(), "vacant": True, "mooving": False}
+        for floor in range(20)
+    ])
+
+    response = client.get("/state", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200, f"Expected status 200, got {response.status_code}"
+    assert response.headers["content-encoding"] == "gzip"
+    assert len(response.json()) >= 20
+
+    response = client.get("/state", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in response.headers
+
 def test_create_and_read_demand():
     """
     Test creating a new elevator demand and retrieving the list of demands.
@@ -90,6 +162,133 @@ def test_create_and_read_demand():
     assert isinstance(demands, list)
     assert len(demands) > 0
 
+def test_create_without_time_uses_database_time():
+    """
+    Test that states and demands logged without a time get the time assigned by the database.
+    
+    Steps:
+      1. POST a resting state and a demand without a time, one by one and in bulk.
+      2. Verify that the created records carry a time.
+      3. Verify that the dataset events carry the same times as the stored records.
+    """
+    
+    response = client.post("/state", json={"current_floor": 11, "vacant": True, "mooving": False})
+    assert response.status_code == 201, f"Expected status 201, got {response.status_code}"
+    state_time = response.json()["state_time"]
+    assert state_time is not None
+
+    response = client.post("/demand", json={"demand_floor": 12})
+    assert response.status_code == 201, f"Expected status 201, got {response.status_code}"
+    demand_time = response.json()["demand_time"]
+    assert demand_time is not None
+
+    response = client.post("/state/bulk", json=[
+        {"current_floor": 13, "vacant": True, "mooving": False},
+        {"current_floor": 14, "state_time": datetime.utcnow().isoformat(), "vacant": True, "mooving": False}
+    ])
+    assert response.status_code == 201, f"Expected status 201, got {response.status_code}"
+    response = client.post("/demand/bulk", json=[{"demand_floor": 15}])
+    assert response.status_code == 201, f"Expected status 201, got {response.status_code}"
+
+    dataset = client.get("/dataset").json()
+    assert {"event_type_is_resting": True, "floor": 11, "time": state_time} in dataset
+    assert {"event_type_is_resting": False, "floor": 12, "time": demand_time} in dataset
+    for floor in (13, 14, 15):
+        assert any(rec["floor"] == floor and rec["time"] is not None for rec in dataset)
+
+def test_create_does_not_reload_record():
+    """
+    Test that logging a record returns it without reading it back from the database.
+    
+    Steps:
+      1. POST a moving state and a demand while counting the statements sent to the database.
+      2. Verify that only the INSERT statements were executed and the id and time are returned.
+    """
+    
+    with recorded_statements() as statements:
+        state = client.post("/state", json={"current_floor": 2, "vacant": False, "mooving": True}).json()
+        demand = client.post("/demand", json={"demand_floor": 2}).json()
+
+    assert state["id"] is not None and state["state_time"] is not None
+    assert demand["id"] is not None and demand["demand_time"] is not None
+    # One INSERT for the state, one for the demand and one for its dataset event.
+    inserts = [statement for statement in statements if statement.startswith("INSERT")]
+    assert len(inserts) == 3, statements
+    # Apart from the dataset snapshot rebuilt in the background, nothing is read back.
+    reads = [statement for statement in statements if not statement.startswith("INSERT")]
+    assert all("FROM events" in statement for statement in reads), statements
+
+def test_response_models_documented():
+    """
+    Test that every endpoint documents its response with an explicit schema.
+    """
+    
+    paths = client.get("/openapi.json").json()["paths"]
+    def response_schema(path, method, status):
+        return paths[path][method]["responses"][status]["content"]["application/json"]["schema"]
+
+    assert response_schema("/state", "get", "200")["items"]["$ref"].endswith("/StateOut")
+    assert response_schema("/state", "post", "201")["$ref"].endswith("/StateOut")
+    assert response_schema("/demand", "get", "200")["items"]["$ref"].endswith("/DemandOut")
+    assert response_schema("/demand", "post", "201")["$ref"].endswith("/DemandOut")
+    assert response_schema("/state/bulk", "post", "201")["$ref"].endswith("/BulkInserted")
+    assert response_schema("/demand/bulk", "post", "201")["$ref"].endswith("/BulkInserted")
+    assert response_schema("/dataset", "get", "200")["items"]["$ref"].endswith("/DatasetEvent")
+
+@pytest.mark.parametrize("path", ["/state", "/demand", "/dataset"])
+def test_get_not_modified(path):
+    """
+    Test that GET endpoints answer 304 Not Modified while the client's copy is current.
+    
+    Steps:
+      1. GET the endpoint and keep its ETag.
+      2. GET it again with If-None-Match and verify the empty 304 response.
+      3. POST a new resting state and a demand, then verify the old ETag gets the full list again.
+    """
+    
+    response = client.get(path)
+    assert response.status_code == 200, f"Expected status 200, got {response.status_code}"
+    etag = response.headers["etag"]
+
+    response = client.get(path, headers={"If-None-Match": etag})
+    assert response.status_code == 304, f"Expected status 304, got {response.status_code}"
+    assert response.content == b""
+
+    client.post("/state", json={"current_floor": 5, "vacant": True, "mooving": False})
+    client.post("/demand", json={"demand_floor": 5})
+
+    response = client.get(path, headers={"If-None-Match": etag})
+    assert response.status_code == 200, f"Expected status 200, got {response.status_code}"
+    assert response.headers["etag"] != etag
+    assert isinstance(response.json(), list)
+
+@pytest.mark.parametrize("path", ["/state", "/demand"])
+def test_get_etag_weak_across_encodings(path):
+    """
+    Test that the list endpoints send a weak ETag, shared by their gzip and identity responses.
+    
+    Steps:
+      1. GET the endpoint with Accept-Encoding: gzip and with Accept-Encoding: identity.
+      2. Verify that both responses carry the same weak ETag.
+      3. Verify that the ETag of either encoding gets a 304 response.
+    """
+    
+    for floor in range(100):
+        client.post("/demand", json={"demand_floor": floor})
+        client.post("/state", json={"current_floor": floor, "vacant": True, "mooving": False})
+
+    compressed = client.get(path, headers={"Accept-Encoding": "gzip"})
+    plain = client.get(path, headers={"Accept-Encoding": "identity"})
+    assert compressed.headers["content-encoding"] == "gzip"
+    assert "content-encoding" not in plain.headers
+    assert compressed.headers["etag"].startswith("W/")
+    assert compressed.headers["etag"] == plain.headers["etag"]
+
+    etag = plain.headers["etag"]
+    for encoding in ("gzip", "identity"):
+        response = client.get(path, headers={"Accept-Encoding": encoding, "If-None-Match": etag})
+        assert response.status_code == 304, f"Expected status 304, got {response.status_code}"
+
 def test_get_dataset():
     """
     Test that the /dataset endpoint returns the apropriate data for training the prediction model.
@@ -136,3 +335,316 @@ def test_get_dataset():
     demand_events = [rec for rec in dataset if rec["event_type_is_resting"] is False]
     assert len(resting_events) > 0, "No resting events found in dataset"
     assert len(demand_events) > 0, "No demand events found in dataset"
+
+def test_get_dataset_single_query():
+    """
+    Test that the /dataset snapshot is built from every event in a single SQL statement.
+    
+    Steps:
+      1. POST several resting states and demands.
+      2. Drop the snapshot and GET the dataset while counting the statements sent to the database.
+      3. Verify that the events were read by a single statement, regardless of their number,
+         besides the highest id lookups deciding whether the snapshot is current.
+    """
+    
+    for minutes in range(3):
+        client.post("/state", json={
+            "current_floor": minutes,
+            "state_time": (datetime.utcnow() - timedelta(minutes=minutes)).isoformat(),
+            "vacant": True,
+            "mooving": False
+        })
+        client.post("/demand", json={
+            "demand_floor": minutes,
+            "demand_time": (datetime.utcnow() - timedelta(minutes=minutes)).isoformat()
+        })
+
+    # Force the snapshot to be rebuilt by the request.
+    main.dataset_snapshot["max_id"] = None
+    with recorded_statements() as statements:
+        response = client.get("/dataset")
+
+    assert response.status_code == 200, f"Expected status 200, got {response.status_code}"
+    assert len(response.json()) >= 6
+    scans = [statement for statement in statements if "max(events.id)" not in statement]
+    assert len(scans) == 1, f"Expected a single query, got {len(scans)}"
+
+def test_get_dataset_snapshot():
+    """
+    Test that /dataset requests are served from the snapshot, rebuilt in the background after new events.
+    
+    Steps:
+      1. GET the dataset twice while counting the statements sent to the database.
+      2. Verify that the second request only looked up the highest event id.
+      3. Log an event behind the application's back, and verify that the next dataset is the
+         snapshot, still young enough, and that the rebuild it scheduled serves the event afterwards.
+      4. POST a demand and verify that the next dataset includes it without rebuilding on the request.
+    """
+    
+    main.dataset_snapshot["max_id"] = None
+    with recorded_statements() as statements:
+        first = client.get("/dataset").json()
+        queries_after_first = len(statements)
+        second = client.get("/dataset").json()
+
+    assert second == first
+    assert len(statements) == queries_after_first + 1, "Dataset snapshot should not be rebuilt"
+    assert "max(events.id)" in statements[-1]
+
+    async def log_event():
+        async with TestingSessionLocal() as db:
+            await db.execute(main.INSERT_EVENT, {"is_resting": False, "floor": 8, "time": datetime.utcnow()})
+            await db.commit()
+
+    asyncio.run(log_event())
+    assert client.get("/dataset").json() == first
+    assert len(client.get("/dataset").json()) == len(first) + 1
+
+    response = client.post("/demand", json={"demand_floor": 7, "demand_time": datetime.utcnow().isoformat()})
+    assert response.status_code == 201, f"Expected status 201, got {response.status_code}"
+    with recorded_statements() as statements:
+        assert len(client.get("/dataset").json()) == len(first) + 2
+    assert len(statements) == 1 and "max(events.id)" in statements[0], statements
+
+def test_get_dataset_snapshot_file():
+    """
+    Test that the dataset snapshot is sent gzip compressed from disk to clients accepting gzip.
+    
+    Steps:
+      1. POST a demand and GET the dataset with Accept-Encoding: gzip.
+      2. Verify the response headers and that the body is the snapshot file, stored in the snapshot directory.
+      3. Remove the snapshot file, GET the dataset with Accept-Encoding: identity and verify
+         the same uncompressed JSON, under an ETag of its own.
+    """
+    
+    client.post("/demand", json={"demand_floor": 6})
+    response = client.get("/dataset", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200, f"Expected status 200, got {response.status_code}"
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["cache-control"] == f"max-age={main.DATASET_SNAPSHOT_MAX_AGE}"
+    assert response.headers["vary"] == "Accept-Encoding"
+    path = main.dataset_snapshot["path"]
+    assert os.path.dirname(path) == main.DATASET_SNAPSHOT_DIR
+    with open(path, "rb") as snapshot:
+        assert gzip.decompress(snapshot.read()) == response.content
+
+    # A snapshot removed by another worker is rebuilt instead of failing the request.
+    os.remove(path)
+    plain = client.get("/dataset", headers={"Accept-Encoding": "identity"})
+    assert plain.status_code == 200, f"Expected status 200, got {plain.status_code}"
+    assert "content-encoding" not in plain.headers
+    assert plain.json() == response.json()
+    assert "Accept-Encoding" in plain.headers["vary"]
+    assert plain.headers["etag"] != response.headers["etag"]
+
+def test_dataset_query_uses_index():
+    """
+    Test that SQLite reads the /dataset events in time order from an index instead of sorting them.
+    
+    Steps:
+      1. Ask SQLite for the query plan of the events ordered by time.
+      2. Verify that the plan walks the time index and needs no temporary sort.
+    """
+    
+    async def explain(query):
+        async with engine_test.connect() as conn:
+            return (await conn.execute(text(f"EXPLAIN QUERY PLAN {query}"))).all()
+
+    plan = asyncio.run(explain("SELECT is_resting, floor, time FROM events ORDER BY time"))
+
+    assert any("ix_events_time" in row.detail for row in plan), plan
+    assert not any("TEMP B-TREE" in row.detail for row in plan), plan
+
+def test_dataset_only_contains_resting_states():
+    """
+    Test that only resting states (vacant and not moving) are materialized as dataset events.
+    
+    Steps:
+      1. POST a resting state, a moving state and an occupied state.
+      2. Verify that only the resting state was added to the dataset.
+    """
+    
+    dataset_before = len(client.get("/dataset").json())
+    state_time = datetime.utcnow().isoformat()
+    for vacant, mooving in ((True, False), (True, True), (False, False)):
+        response = client.post("/state", json={
+            "current_floor": 9, "state_time": state_time, "vacant": vacant, "mooving": mooving
+        })
+        assert response.status_code == 201, f"Expected status 201, got {response.status_code}"
+
+    dataset = client.get("/dataset").json()
+    assert len(dataset) == dataset_before + 1
+    assert {"event_type_is_resting": True, "floor": 9, "time": state_time} in dataset
+
+def test_migrate_events(tmp_path):
+    """
+    Test that migrate_events.sql adds the events table to a database created before it existed.
+    
+    Steps:
+      1. Create the states and demands tables without events, and log some records.
+      2. Run the migration twice.
+      3. Verify that the events hold the resting states and demands once, in time order.
+    """
+    
+    conn = sqlite3.connect(tmp_path / "old.db")
+    conn.executescript("""
+        CREATE TABLE states(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            current_floor INTEGER NOT NULL,
+            state_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            vacant BOOLEAN NOT NULL,
+            mooving BOOLEAN NOT NULL
+        );
+        CREATE TABLE demands (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            demand_floor INTEGER NOT NULL,
+            demand_time  TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        INSERT INTO states (current_floor, state_time, vacant, mooving) VALUES
+            (1, '2025-01-01 10:00:00', 1, 0),
+            (2, '2025-01-01 10:05:00', 1, 1),
+            (3, '2025-01-01 10:10:00', 0, 0);
+        INSERT INTO demands (demand_floor, demand_time) VALUES (4, '2025-01-01 10:02:00');
+    """)
+    migration = open(os.path.join(os.path.dirname(__file__), "migrate_events.sql")).read()
+    conn.executescript(migration)
+    conn.executescript(migration)
+
+    events = conn.execute("SELECT is_resting, floor, time FROM events ORDER BY id").fetchall()
+    conn.close()
+    assert events == [(1, 1, "2025-01-01 10:00:00"), (0, 4, "2025-01-01 10:02:00")]
+
+def test_sqlite_pragmas(tmp_path):
+    """
+    Test that the connection listener tunes SQLite for concurrent reads and cheap commits.
+    
+    Steps:
+      1. Attach the listener to an engine backed by a temporary database file.
+      2. Open a connection and read back the pragmas.
+      3. Verify that WAL journaling and NORMAL synchronous mode are enabled.
+    """
+    
+    engine_file = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'pragmas.db'}")
+    event.listen(engine_file.sync_engine, "connect", set_sqlite_pragma)
+
+    async def read_pragmas():
+        try:
+            async with engine_file.connect() as conn:
+                return [
+                    (await conn.execute(text(f"PRAGMA {name}"))).scalar()
+                    for name in ("journal_mode", "synchronous", "foreign_keys")
+                ]
+        finally:
+            await engine_file.dispose()
+
+    journal_mode, synchronous, foreign_keys = asyncio.run(read_pragmas())
+    assert journal_mode == "wal"
+    # NORMAL synchronous mode is reported as 1.
+    assert synchronous == 1
+    assert foreign_keys == 1
+
+def test_relationships_are_not_lazy_loaded():
+    """
+    Test that no model relationship is lazy loaded per row.
+    
+    Steps:
+      1. Walk every mapper registered on the models' Base.
+      2. Verify that none of their relationships uses the default lazy="select" strategy.
+    """
+    
+    lazy_loaded = [
+        str(relationship)
+        for mapper in Base.registry.mappers
+        for relationship in mapper.relationships
+        if relationship.lazy in ("select", True)
+    ]
+    assert lazy_loaded == [], f"Declare these relationships with lazy=\"raise\": {lazy_loaded}"
+
+def test_get_db_session_scoped_per_task():
+    """
+    Test that get_db hands out one session per asyncio task and releases it afterwards.
+    
+    Steps:
+      1. Open the get_db dependency in two concurrent tasks.
+      2. Verify that each task sees its own session through the SessionLocal registry.
+      3. Verify that closing the dependency removes the session from the registry.
+    """
+    
+    async def open_session():
+        dependency = get_db()
+        db = await dependency.__anext__()
+        same_in_task = SessionLocal() is db
+        await dependency.aclose()
+        return db, same_in_task, SessionLocal.registry.has()
+
+    async def open_two_sessions():
+        return await asyncio.gather(open_session(), open_session())
+
+    (first, first_same, first_kept), (second, second_same, second_kept) = asyncio.run(open_two_sessions())
+    assert first_same and second_same
+    assert first is not second
+    assert not first_kept and not second_kept
+
+def test_engine_connection_pool():
+    """
+    Test that the application engine keeps a pool of several connections instead of a single one.
+    """
+    
+    assert isinstance(engine.pool, AsyncAdaptedQueuePool)
+    assert engine.pool.size() == 5
+
+def test_create_bulk_states_and_demands():
+    """
+    Test logging many states and demands at once through the bulk endpoints.
+    
+    Steps:
+      1. POST a list of state records to /state/bulk.
+      2. POST a list of demand records to /demand/bulk.
+      3. Verify the inserted counts and that the records can be retrieved.
+    """
+    
+    states_before = len(client.get("/state").json())
+    demands_before = len(client.get("/demand").json())
+    dataset_before = len(client.get("/dataset").json())
+
+    states_payload = [
+        {
+            "current_floor": floor,
+            "state_time": (datetime.utcnow() + timedelta(seconds=floor)).isoformat(),
+            "vacant": floor % 2 == 0,
+            "mooving": False
+        }
+        for floor in range(5)
+    ]
+    response = client.post("/state/bulk", json=states_payload)
+    assert response.status_code == 201, f"Expected status 201, got {response.status_code}"
+    assert response.json() == {"inserted": 5}
+
+    demands_payload = [
+        {
+            "demand_floor": floor,
+            "demand_time": (datetime.utcnow() + timedelta(seconds=floor)).isoformat()
+        }
+        for floor in range(3)
+    ]
+    response = client.post("/demand/bulk", json=demands_payload)
+    assert response.status_code == 201, f"Expected status 201, got {response.status_code}"
+    assert response.json() == {"inserted": 3}
+
+    assert len(client.get("/state").json()) == states_before + 5
+    assert len(client.get("/demand").json()) == demands_before + 3
+    # Three of the states are resting (vacant and not moving), plus the three demands.
+    assert len(client.get("/dataset").json()) == dataset_before + 6
+
+def test_create_bulk_rejects_invalid_records():
+    """
+    Test that a bulk request with an invalid record is rejected as a whole.
+    """
+    
+    states_before = len(client.get("/state").json())
+    response = client.post("/state/bulk", json=[
+        {"current_floor": 1, "state_time": datetime.utcnow().isoformat(), "vacant": True, "mooving": False},
+        {"current_floor": "not a floor", "state_time": datetime.utcnow().isoformat(), "vacant": True, "mooving": False}
+    ])
+    assert response.status_code == 422, f"Expected status 422, got {response.status_code}"
+    assert len(client.get("/state").json()) == states_before